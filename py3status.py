@@ -17,27 +17,292 @@
 
 import json
 from subprocess import Popen, call, PIPE, call, check_output, DEVNULL
-from socket import socket, SOCK_DGRAM
-from threading import Thread, Event, Lock
-from queue import Queue
-from time import sleep, strftime
+from socket import socket, SOCK_DGRAM, AF_UNIX, SHUT_RDWR
+from threading import Thread, Event, Lock, RLock, Condition, enumerate as threads, get_ident
+from queue import Queue, Empty, Full
+from multiprocessing import get_context
+from time import sleep, strftime, time, monotonic, clock_gettime, CLOCK_BOOTTIME
 from configparser import ConfigParser
 from os.path import expanduser
+from fnmatch import fnmatch
+from collections import namedtuple
+from glob import glob
 from array import array
 from struct import pack
 from fcntl import ioctl
 import re
 import os
+import string
 import ctypes
 import sys
 import pickle
 import signal
 import logging
+import logging.handlers
+import argparse
 
 from mpd import MPDClient, ConnectionError
 import psutil
 
 
+# Byte multiples used by human_size(), largest first
+SIZE_SUFFIXES = tuple((pow(2, n * 10), suffix)
+                      for n, suffix in reversed(list(enumerate('BKMGTP'))))
+
+
+def human_size(byte):
+    '''
+    Present amount of bytes in human-readable format.
+    '''
+    if byte == 0:
+        return '0.0 B'
+    for value, suffix in SIZE_SUFFIXES:
+        if byte >= value:
+            return '{:.1f} {}'.format(byte / value, suffix)
+    return '{:.1f} B'.format(byte)
+
+
+def drain(queue):
+    '''
+    Waits for a command, then takes every other one already queued, so
+    a burst of key presses can be handled in one go.
+    '''
+    commands = [queue.get()]
+    while True:
+        try:
+            commands.append(queue.get_nowait())
+        except Empty:
+            return commands
+
+
+class Template():
+    '''
+    User supplied format of full_text, parsed once. Fields work like in
+    str.format(), {free!h} shows bytes in human-readable format. Parts in
+    [brackets] are only shown when none of their fields is empty or zero,
+    [[ and ]] stand for literal brackets. If the fields used are the same
+    as the last time, so is the result.
+    '''
+    conversions = {'h': human_size, 's': str, 'r': repr, 'a': ascii}
+
+    def __init__(self, fmt, fields):
+        self.segments = []  # (conditional, [(literal, field, spec, conversion)])
+        self.fields = []  # names of the fields used, in order
+        formatter = string.Formatter()
+        for conditional, text in self._split(fmt):
+            parts = []
+            for literal, field, spec, conversion in formatter.parse(text):
+                if field is not None and field not in fields:
+                    raise ValueError('Unknown field {{{}}} in format {!r}, '
+                                     'use one of: {}'.format(field, fmt, ', '.join(fields)))
+                if conversion and conversion not in self.conversions:
+                    raise ValueError('Unknown conversion !{} in format {!r}'.format(
+                        conversion, fmt))
+                if field is not None and field not in self.fields:
+                    self.fields.append(field)
+                parts.append((literal, field, spec,
+                              self.conversions[conversion] if conversion else None))
+            self.segments.append((conditional, parts))
+        self.fields = tuple(self.fields)
+        self._values = None
+        self._rendered = ''
+
+    @staticmethod
+    def _split(fmt):
+        '''Returns (conditional, text) for parts outside and inside brackets.'''
+        parts = []
+        text = []
+        conditional = False
+        i = 0
+        while i < len(fmt):
+            char = fmt[i]
+            if char in '[]' and fmt[i + 1:i + 2] == char:
+                text.append(char)
+                i += 2
+                continue
+            if char == '[':
+                if conditional:
+                    raise ValueError('Nested [ in format {!r}, '
+                                     'use [[ for a literal one'.format(fmt))
+            elif char == ']':
+                if not conditional:
+                    raise ValueError('Unmatched ] in format {!r}, '
+                                     'use ]] for a literal one'.format(fmt))
+            else:
+                text.append(char)
+                i += 1
+                continue
+            if text:
+                parts.append((conditional, ''.join(text)))
+            text = []
+            conditional = not conditional
+            i += 1
+        if conditional:
+            raise ValueError('Unclosed [ in format {!r}'.format(fmt))
+        if text:
+            parts.append((conditional, ''.join(text)))
+        return parts
+
+    def render(self, **fields):
+        '''Fields not used may be left out.'''
+        values = tuple(fields[field] for field in self.fields)
+        if values == self._values:
+            return self._rendered
+        output = []
+        for conditional, parts in self.segments:
+            segment = []
+            for literal, field, spec, conversion in parts:
+                segment.append(literal)
+                if field is None:
+                    continue
+                value = fields[field]
+                if conditional and not value:
+                    break
+                if conversion:
+                    value = conversion(value)
+                segment.append(format(value, spec))
+            else:
+                output.extend(segment)
+        self._values = values
+        self._rendered = ''.join(output)
+        return self._rendered
+
+
+class History():
+    '''
+    Fixed size ring buffer of readings, for showing trends. Values and
+    timestamps live in preallocated arrays, so recording a reading
+    doesn't allocate anything.
+    '''
+    sparks = '\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+    def __init__(self, capacity, alpha=0.1):
+        self.capacity = int(capacity)
+        self.values = array('f', [0.0]) * self.capacity
+        self.times = array('d', [0.0]) * self.capacity
+        self.index = 0  # where the next reading goes
+        self.length = 0
+        self.alpha = alpha
+        self.ewma = None  # exponentially weighted moving average
+
+    def __len__(self):
+        return self.length
+
+    def append(self, value, timestamp=None):
+        self.values[self.index] = value
+        self.times[self.index] = time() if timestamp is None else timestamp
+        self.index = (self.index + 1) % self.capacity
+        if self.length < self.capacity:
+            self.length += 1
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+
+    def _filled(self):
+        # Order doesn't matter for min/max, skip the copy
+        return memoryview(self.values)[:self.length]
+
+    def min(self):
+        return min(self._filled()) if self.length else None
+
+    def max(self):
+        return max(self._filled()) if self.length else None
+
+    def last(self, count=1):
+        '''Returns up to count latest readings, oldest first.'''
+        count = min(count, self.length)
+        start = self.index - count
+        if start >= 0:
+            return self.values[start:self.index]
+        return self.values[start:] + self.values[:self.index]
+
+    def rate(self):
+        '''Change per hour between the oldest and the latest reading.'''
+        if self.length < 2:
+            return 0.0
+        oldest = self.index - self.length  # negative index wraps around
+        newest = self.index - 1
+        elapsed = self.times[newest] - self.times[oldest]
+        if not elapsed:
+            return 0.0
+        return (self.values[newest] - self.values[oldest]) * 3600 / elapsed
+
+    def sparkline(self, width):
+        values = self.last(width)
+        if not values:
+            return ''
+        low = min(values)
+        spread = (max(values) - low) or 1
+        top = len(self.sparks) - 1
+        return ''.join(self.sparks[int((value - low) * top / spread)]
+                       for value in values)
+
+
+# Template fields every thread keeping history offers, see WorkerThread._trend()
+TREND_FIELDS = ('spark', 'min', 'max', 'avg', 'rate')
+
+
+class Block():
+    '''
+    Immutable snapshot of what a thread shows. Threads swap in a new one
+    for every change, so anyone can read the current one without locking
+    and telling if something changed is a matter of comparing versions.
+    '''
+    __slots__ = ('name', 'full_text', 'color', 'urgent', 'show',
+                 'separator', 'separator_block_width', 'version', '_output')
+    fields = __slots__[:-1]
+
+    def __init__(self, name, full_text='', color=None, urgent=False, show=False,
+                 separator=True, separator_block_width=9, version=0):
+        setattr_ = object.__setattr__
+        setattr_(self, 'name', name)
+        setattr_(self, 'full_text', full_text)
+        setattr_(self, 'color', color)
+        setattr_(self, 'urgent', urgent)
+        setattr_(self, 'show', show)
+        setattr_(self, 'separator', separator)
+        setattr_(self, 'separator_block_width', separator_block_width)
+        setattr_(self, 'version', version)
+        setattr_(self, '_output', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Block is immutable')
+
+    def replace(self, **changes):
+        '''
+        Returns a Block with given fields changed and a bumped version,
+        or this one if nothing would change.
+        '''
+        for field, value in changes.items():
+            if getattr(self, field) != value:
+                break
+        else:
+            return self
+        fields = {field: getattr(self, field) for field in self.fields}
+        fields.update(changes)
+        fields['version'] = self.version + 1
+        return Block(**fields)
+
+    def output(self):
+        '''
+        Returns a dictionary ready to be sent to i3bar. It's built once
+        and shared, don't modify it.
+        '''
+        if self._output is None:
+            output = {'full_text': self.full_text,
+                      'name': self.name,
+                      'separator': self.separator,
+                      'separator_block_width': self.separator_block_width
+                      }
+            if self.color:
+                output['color'] = self.color
+            if self.urgent:
+                output['urgent'] = self.urgent
+            object.__setattr__(self, '_output', output)
+        return self._output
+
+
 class WorkerThread(Thread):
     '''
     Skeleton Class for all worker threads.
@@ -52,15 +317,26 @@ class WorkerThread(Thread):
                  color_normal,
                  separator,
                  separator_block_width,
+                 history=0,
+                 sparkline=0,
+                 format=None,
                  **kwargs):
         Thread.__init__(self, **kwargs)
         self.daemon = True  # kill threads when StatusBar exits
-        self.show = False
-        self.urgent = False
+        self.name = name
+        # What the thread shows, replaced by _set()
+        self.block = Block(name,
+                           color=color_normal,
+                           separator=separator,
+                           separator_block_width=int(separator_block_width))
+        self._block_lock = Lock()
+        # Held across sending and its bookkeeping, _fill_queue() is called
+        # from more than one thread
+        self._fill_lock = Lock()
+        self._sent_version = None  # version of the block last sent out
         self.blanked = True  # was the output empty previously?
         self.interval = int(interval)
-        self.name = name
-        self.idn = idn  # Identification number, sort of
+        self.idn = idn  # Name of the config section
         self.color_warning = color_warning
         self.color_critical = color_critical
         self.color_normal = color_normal
@@ -69,33 +345,101 @@ class WorkerThread(Thread):
         self.separator_block_width = int(separator_block_width)
         self.active = Event()
         self.active.set()
+        self.stopped = Event()
+        self.wakeup = Event()  # cuts the wait between checks short
+        self._forced = False  # report on next _fill_queue(), changed or not
+        self.heartbeat = None  # called after every check, if set
         self.pausable = True
+        # Readings kept for trends, only if asked for in the config
+        self.sparkline = int(sparkline)
+        history = max(int(history), self.sparkline)
+        self.history = History(history) if history else None
+        # Latest raw readings, served by MetricsServer
+        self.metrics = {}
+        # full_text format from the config, see _template()
+        self.format = format
 
-        # Template for self._data, mangled by get_output()
-        self._data = {'full_text': '',
-                      'color': self.color_normal,
-                      'separator': self.separator,
-                      'separator_block_width': self.separator_block_width
-                      }
+    def _set(self, **changes):
+        '''
+        Change what the thread shows. Safe to call from any thread, the
+        block is never modified, only replaced.
+        '''
+        with self._block_lock:
+            self.block = self.block.replace(**changes)
+
+    @property
+    def show(self):
+        return self.block.show
+
+    @show.setter
+    def show(self, value):
+        self._set(show=value)
+
+    @property
+    def urgent(self):
+        return self.block.urgent
 
-        # prevoius value of _data, for comparision
-        self._data_prev = self._data.copy()
+    @urgent.setter
+    def urgent(self, value):
+        self._set(urgent=value)
 
     def _fill_queue(self):
-        if self.show and (True if self.blanked
-                          else (self._data != self._data_prev)):
-            self.queue.put((self.idn, self.get_output()))
-            self._data_prev = self._data.copy()
-            self.blanked = False
-        elif not self.show if not self.blanked else False:
-            self.queue.put((self.idn, None))
-            self.blanked = True
+        with self._fill_lock:
+            block = self.block
+            forced, self._forced = self._forced, False
+            if block.show:
+                if forced or self.blanked or block.version != self._sent_version:
+                    self.queue.put((self.idn, block.output()))
+                    self._sent_version = block.version
+                    self.blanked = False
+            elif forced or not self.blanked:
+                self.queue.put((self.idn, None))
+                self.blanked = True
+
+    def _record(self, value):
+        '''Remember a reading, if this thread keeps history.'''
+        if self.history is not None:
+            self.history.append(value)
+            self.metrics['history_average'] = self.history.ewma
+            self.metrics['history_rate_per_hour'] = self.history.rate()
+
+    def _trend(self, template):
+        '''
+        Values of the TREND_FIELDS the template uses: the sparkline,
+        lowest, highest, average and change per hour of the remembered
+        readings. Empty or zero without history, so they can go in
+        [brackets].
+        '''
+        history = self.history
+        trend = {}
+        for field in template.fields:
+            if field not in TREND_FIELDS:
+                continue
+            if not history:
+                trend[field] = '' if field == 'spark' else 0.0
+            elif field == 'spark':
+                trend[field] = history.sparkline(self.sparkline) if self.sparkline else ''
+            elif field == 'min':
+                trend[field] = history.min()
+            elif field == 'max':
+                trend[field] = history.max()
+            elif field == 'avg':
+                trend[field] = history.ewma
+            else:
+                trend[field] = history.rate()
+        return trend
+
+    def _template(self, default, *fields):
+        '''
+        Compile the format from the config (or default) to a Template
+        accepting given fields.
+        '''
+        return Template(self.format or default, fields)
 
     def _update_data(self):
         '''
-        This function has to manipulate self._data variable that
-        should store internal readings ready to be dumped by
-        get_output().
+        This function has to update the block through _set() with
+        internal readings ready to be dumped by get_output().
         '''
         raise NotImplementedError()
 
@@ -103,16 +447,7 @@ class WorkerThread(Thread):
         '''
         Returns a dictionary ready to be sent to i3bar.
         '''
-        output = {'full_text': self._data['full_text'],
-                  'name': self.name,
-                  'separator': self._data['separator'],
-                  'separator_block_width': self._data['separator_block_width']
-                  }
-        if self._data['color']:
-            output['color'] = self._data['color']
-        if self.urgent:
-            output['urgent'] = self.urgent
-        return output
+        return self.block.output()
 
     def handle(self, sig):
         if sig == signal.SIGUSR1:
@@ -126,18 +461,233 @@ class WorkerThread(Thread):
         
     def unpause(self):
         self.active.set()
+
+    def refresh(self):
+        '''
+        Check and report right away, even if nothing has changed.
+        Used after a pause or a suspend.
+        '''
+        self._forced = True
+        if hasattr(self, 'commandq'):
+            # Threads waiting for commands need one to wake up
+            self.commandq.put('refresh')
+        self.wakeup.set()
+
+    def stop(self):
+        '''
+        Ask the thread to finish, used when its config section
+        changes or goes away.
+        '''
+        self.stopped.set()
+        self.active.set()
+        self.wakeup.set()
+        if hasattr(self, 'commandq'):
+            # Wake up threads waiting for commands
+            self.commandq.put('')
     
     def run(self):
         '''Main worker loop.'''
-        while True:
+        while not self.stopped.is_set():
             try:
                 self.active.wait()
+                self.wakeup.clear()
                 self._update_data()
+                if self.stopped.is_set():
+                    break
                 self._fill_queue()
-                sleep(self.interval)
+                if self.heartbeat:
+                    self.heartbeat()
+                self.wakeup.wait(self.interval)
             except Exception as e:
                 logging.exception('Caught exception in the worker thread %s!', self.name)
 
+class PipeQueue():
+    '''
+    Stands in for the update queue inside of a worker process. Every
+    message is sent to the parent as a single frame, a JSON-encoded
+    [kind, payload] pair, the pipe takes care of the length prefix.
+    Kinds are 'o' for output (or null), 'b' for a heartbeat, which
+    carries the worker's metrics, and 'l' for a log record.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = Lock()
+
+    def send(self, kind, payload=None):
+        frame = json.dumps([kind, payload]).encode()
+        try:
+            with self.lock:
+                self.connection.send_bytes(frame)
+        except OSError:
+            # StatusBar is gone, there is no one left to report to
+            os._exit(0)
+
+    def put(self, item):
+        idn, entry = item
+        self.send('o', entry)
+
+    def beat(self, metrics=None):
+        self.send('b', metrics)
+
+
+class PipeLogHandler(logging.Handler):
+    '''
+    Sends log records of a worker process to the StatusBar, which logs
+    them as its own. Only the formatted message and traceback make it.
+    '''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            self.format(record)  # fills in record.message and exc_text
+            self.queue.send('l', {'name': record.name,
+                                  'levelno': record.levelno,
+                                  'levelname': record.levelname,
+                                  'msg': record.message,
+                                  'exc_text': record.exc_text,
+                                  'created': record.created})
+        except Exception:
+            self.handleError(record)
+
+
+class ProcessWorker(Thread):
+    '''
+    Runs a worker in a separate process, so it can't stall the rest of
+    the bar, and relays its output to the StatusBar queue. Crashed
+    processes are restarted, waiting longer after every failure.
+    '''
+    signals = {signal.SIGUSR1, signal.SIGUSR2}
+    # Workers taking commands can't run in a process, all others pause
+    pausable = True
+
+    def __init__(self, class_type, arguments, max_delay=60):
+        Thread.__init__(self)
+        self.daemon = True
+        self.class_type = class_type
+        self.arguments = arguments
+        self.name = arguments['name']
+        self.idn = arguments['idn']
+        self.queue = arguments['queue']
+        self.max_delay = max_delay
+        # A worker that sent no heartbeat for this long is hung
+        self.timeout = int(arguments['interval']) * 3 + 30
+        self.context = get_context('fork')
+        self.process = None
+        self.paused = False
+        self.stopped = Event()
+        # Keeps signals from falling between a fork and the pid being
+        # known, and output from landing after stop()
+        self.lock = Lock()
+        self.metrics = {}  # as of the last heartbeat
+
+    def _serve(self, connection):
+        '''Entry point of the worker process.'''
+        # Signals are blocked since before the fork, as the handlers
+        # inherited from the StatusBar must never run here. Those sent
+        # in the meantime are delivered once ours are in place.
+        queue = PipeQueue(connection)
+        # The log file is the StatusBar's to write, records go through it
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(PipeLogHandler(queue))
+        arguments = dict(self.arguments, queue=queue)
+        worker = globals()[self.class_type](**arguments)
+        worker.heartbeat = lambda: queue.beat(worker.metrics)
+        if self.paused:
+            # Restarted while the bar is hidden
+            worker.pause()
+        def handler(sig, frame):
+            worker.handle(sig)
+            # SIGUSR2 also stands for refresh()
+            if sig == signal.SIGUSR2:
+                worker.refresh()
+        signal.signal(signal.SIGUSR1, handler)
+        signal.signal(signal.SIGUSR2, handler)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+        worker.run()
+
+    def handle(self, sig):
+        with self.lock:
+            if sig == signal.SIGUSR1:
+                self.paused = True
+            elif sig == signal.SIGUSR2:
+                self.paused = False
+            process = self.process
+            if process and process.pid:
+                try:
+                    os.kill(process.pid, sig)
+                except OSError:
+                    pass  # Already gone, will be restarted
+
+    def refresh(self):
+        # SIGUSR2 unpauses too, a parked worker is refreshed on resume
+        if not self.paused:
+            self.handle(signal.SIGUSR2)
+
+    def stop(self):
+        with self.lock:
+            self.stopped.set()
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+
+    def run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            reader, writer = self.context.Pipe(duplex=False)
+            self.process = self.context.Process(target=self._serve,
+                                                args=(writer,),
+                                                daemon=True)
+            # The child unblocks them once its own handlers are in place
+            signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+            try:
+                with self.lock:
+                    self.process.start()
+            finally:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+            writer.close()
+            try:
+                while True:
+                    if not reader.poll(self.timeout):
+                        if self.paused:
+                            continue  # Parked workers don't beat
+                        logging.warning('Worker process %s hung, killing it.', self.name)
+                        break
+                    kind, payload = json.loads(reader.recv_bytes().decode())
+                    if kind == 'o':
+                        with self.lock:
+                            # A new thread for the section may be running
+                            if not self.stopped.is_set():
+                                self.queue.put((self.idn, payload))
+                    elif kind == 'b' and payload is not None:
+                        self.metrics = payload
+                    elif kind == 'l':
+                        record = logging.makeLogRecord(payload)
+                        logging.getLogger(record.name).handle(record)
+                    delay = 1
+            except EOFError:
+                pass
+            except Exception as e:
+                logging.exception('Caught exception while relaying %s!', self.name)
+            finally:
+                reader.close()
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+            if self.stopped.is_set():
+                break
+            logging.warning('Worker process %s exited with code %s, restarting in %ss.',
+                            self.name, self.process.exitcode, delay)
+            # Blank the entry while the worker is down
+            self.queue.put((self.idn, None))
+            self.metrics = {}
+            self.stopped.wait(delay)
+            delay = min(delay * 2, self.max_delay)
+
+
 class ClickEventHandler(Thread):
     '''
     Handle Click events.
@@ -145,32 +695,39 @@ class ClickEventHandler(Thread):
     def __init__(self, **kwargs):
         Thread.__init__(self, **kwargs)
         self.daemon = True
+        self.name = 'ClickEventHandler'
         self.calendar_name = 'gsimplecal'
         self.event_name = 'Date'
         self.calendar = None
+        self.recorder = None
         
     def run(self):
         for event in sys.stdin:
-            try:
-                if event.startswith('['):
-                    continue
-                elif event.startswith(','):
-                    event = event.lstrip(',')
-                
-                name = json.loads(event)['name']
-                
-                if name == self.event_name:
-                    if self.calendar == None:
-                        self.on()
-                    else:
-                        if self.calendar.poll() == None:
-                            self.off()
-                        else:
-                            self.on() #calendar killed outside
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        if self.recorder:
+            self.recorder.record('click', event=event)
+        try:
+            if event.startswith('['):
+                return
+            elif event.startswith(','):
+                event = event.lstrip(',')
+
+            name = json.loads(event)['name']
+
+            if name == self.event_name:
+                if self.calendar == None:
+                    self.on()
                 else:
-                    pass
-            except Exception as e:
-                logging.exception('Caught exception in the click handler!')
+                    if self.calendar.poll() == None:
+                        self.off()
+                    else:
+                        self.on() #calendar killed outside
+            else:
+                pass
+        except Exception as e:
+            logging.exception('Caught exception in the click handler!')
     
     def on(self):
         self.calendar = Popen(self.calendar_name, stdout=DEVNULL)
@@ -190,6 +747,8 @@ class GetTemp(WorkerThread):
         WorkerThread.__init__(self, **kwargs)
         self.temp_warning = float(temp_warning)
         self.temp_critical = float(temp_critical)
+        self.template = self._template('{name}: {temp}C[ {spark}]',
+                                       'name', 'temp', *TREND_FIELDS)
 
     def _check_temp(self, temp):
         '''
@@ -197,17 +756,18 @@ class GetTemp(WorkerThread):
         value, display it and set urgency. Stop displaying when
         temperature drops below temp_warning threshold.
         '''
+        self._record(temp)
+        self.metrics['temperature_celsius'] = temp
+        full_text = self.template.render(name=self.name, temp=temp,
+                                         **self._trend(self.template))
         if temp >= self.temp_critical:
-            self._data['color'] = self.color_critical
-            self.urgent = True
-            self.show = True
+            self._set(full_text=full_text, color=self.color_critical,
+                      urgent=True, show=True)
         elif self.temp_warning <= temp < self.temp_critical:
-            self._data['color'] = self.color_warning
-            self.urgent = False
+            self._set(full_text=full_text, color=self.color_warning,
+                      urgent=False)
         elif temp < self.temp_warning:
-            self.show = False
-            self.urgent = False
-        self._data['full_text'] = '{}: {}C'.format(self.name, temp)
+            self._set(full_text=full_text, show=False, urgent=False)
         
         
 class Toggler(WorkerThread):
@@ -228,8 +788,8 @@ class Toggler(WorkerThread):
         observer.register_command(self.name, self.commandq)
         # Override default interval, fifo will serve as a timer/blocker
         self.interval = 0
-        self._data['color'] = self.color_warning
-        self._data['full_text'] = self.name
+        self._set(color=self.color_warning,
+                  full_text=self._template('{name}', 'name').render(name=self.name))
         self.pausable = False #Key events should work regardless of i3bar's state
         
     def _show(self):
@@ -263,11 +823,29 @@ class Toggler(WorkerThread):
         self.show = True
     
     def _update_data(self):
-        command = self.commandq.get().lower()
-        try:
-            getattr(self, command)()
-        except AttributeError:
-            pass
+        # Only the last command other than toggle matters, and the
+        # toggles after it cancel out in pairs
+        action = None
+        toggles = 0
+        refresh = False
+        for command in drain(self.commandq):
+            command = command.lower()
+            if command == 'toggle':
+                toggles += 1
+            elif command == 'refresh':
+                refresh = True
+            elif command:
+                action = command
+                toggles = 0
+        if action:
+            try:
+                getattr(self, action)()
+            except AttributeError:
+                pass
+        if toggles % 2:
+            self.toggle()
+        elif refresh and not action:
+            self.show = self._is_disabled()
 
 
 class FIFObserver(Thread):
@@ -278,22 +856,24 @@ class FIFObserver(Thread):
     def __init__(self, **kwargs):
         Thread.__init__(self, **kwargs)
         self.daemon = True
+        self.name = 'FIFObserver'
         self.dir = '/tmp/' + os.getenv('USER')
         self.fullpath = self.dir + '/py3status.fifo'
         self._make_fifo()
         # Avaible commands to be processed by this class
         # Registered with register_command()
         self._commands = {}
+        self.recorder = None
 
     def _make_fifo(self):
+        # The directory is shared with the daemon socket, so only the
+        # FIFO itself gets recreated.
+        os.makedirs(self.dir, exist_ok=True)
         try:
             os.remove(self.fullpath)
-            os.rmdir(self.dir)
         except OSError:
             pass
-        finally:
-            os.mkdir(self.dir)
-            os.mkfifo(self.fullpath)
+        os.mkfifo(self.fullpath)
 
     def register_command(self, command, queue):
         if not command in self._commands:
@@ -301,6 +881,21 @@ class FIFObserver(Thread):
         else:
             raise KeyError('Command already registered')
 
+    def unregister_queue(self, queue):
+        '''Forget every command handled by given queue, returns them.'''
+        commands = [command for command, registered in self._commands.items()
+                    if registered is queue]
+        for command in commands:
+            del self._commands[command]
+        return commands
+
+    def registered(self):
+        '''Names of the commands registered so far.'''
+        return set(self._commands)
+
+    def unregister_command(self, command):
+        self._commands.pop(command, None)
+
     def run(self):
         while True:
             try:
@@ -316,12 +911,284 @@ class FIFObserver(Thread):
                     pass
                 else:
                     target, command = target.lower(), command.lower()
+                    if self.recorder:
+                        self.recorder.record('command', target=target, command=command)
                     if target in self._commands:
                         self._commands[target].put(command)
             except Exception as e:
                 logging.exception('Caught exception in the observer!')
 
 
+class BarServer(Thread):
+    '''
+    Serves the output of a py3status daemon to any number of BarClients
+    over a Unix socket. The first line sent by a client is a JSON list of
+    sections it wants to show (empty for all of them), every following
+    line is a click event. Clients get one JSON array per update, each
+    from its own Output thread, so a stuck bar only holds up itself.
+    '''
+    def __init__(self, path, clickeventhandler, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'BarServer'
+        self.path = path
+        self.clickeventhandler = clickeventhandler
+        # connection: (sections to send, empty for all, Output)
+        self.clients = {}
+        self.data = {}
+        self.order = []
+        self.lock = Lock()
+        self.encoder = JSONLinesEncoder()
+        self.listener = socket(AF_UNIX)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.listener.bind(self.path)
+        self.listener.listen(5)
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+                Thread(target=self._serve_client, args=(connection,),
+                       daemon=True).start()
+            except Exception as e:
+                logging.exception('Caught exception in the bar server!')
+
+    @staticmethod
+    def _hang_up(connection):
+        # Wakes up the reader thread, which cleans up after it
+        try:
+            connection.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _serve_client(self, connection):
+        stream = connection.makefile('r')
+        output = Output(self.encoder, connection.fileno(),
+                        on_close=lambda: self._hang_up(connection))
+        try:
+            wanted = json.loads(stream.readline() or 'null') or []
+            output.start()
+            with self.lock:
+                self.clients[connection] = (wanted, output)
+                self._send(wanted, output)
+            for event in stream:
+                self.clickeventhandler.handle_event(event)
+        except Exception as e:
+            logging.exception('Caught exception while serving a bar client!')
+        finally:
+            with self.lock:
+                self.clients.pop(connection, None)
+            output.close()
+            output.join(1)
+            stream.close()
+            connection.close()
+
+    def _send(self, wanted, output):
+        items = [self.data[section] for section in (wanted or self.order)
+                 if self.data.get(section)]
+        output.put(self.encoder.encode(items))
+
+    def broadcast(self, data, order):
+        with self.lock:
+            self.data = dict(data)
+            self.order = order
+            for wanted, output in self.clients.values():
+                self._send(wanted, output)
+
+
+class I3barEncoder():
+    '''
+    i3bar (and swaybar) JSON protocol, an endless JSON array of frames.
+    '''
+    header = b'{"version":1, "click_events": true, "stop_signal": 10, "cont_signal": 12 }\n[\n'
+    separator = b','  # goes before every frame but the first
+
+    def encode(self, items):
+        return json.dumps(items).encode()
+
+
+class LemonbarEncoder():
+    '''
+    Plain text line per frame, with lemonbar color tags. Urgent entries
+    get their colors swapped.
+    '''
+    header = b''
+    separator = b''
+
+    def encode(self, items):
+        line = []
+        for item in items:
+            text = item['full_text'].replace('%', '%%')
+            if item.get('color'):
+                text = '%{{F{}}}{}%{{F-}}'.format(item['color'], text)
+            if item.get('urgent'):
+                text = '%{R}' + text + '%{R}'
+            line.append(text)
+            line.append(' | ' if item.get('separator') else '  ')
+        return ''.join(line[:-1]).encode()
+
+
+class JSONLinesEncoder(I3barEncoder):
+    '''
+    One JSON array per line, for other programs to read. The frames of
+    i3bar, without the header and the commas.
+    '''
+    header = b''
+    separator = b''
+
+
+# Encoders selectable with --output
+ENCODERS = {'i3bar': I3barEncoder,
+            'lemonbar': LemonbarEncoder,
+            'jsonlines': JSONLinesEncoder
+            }
+
+
+class Output(Thread):
+    '''
+    Writes encoded frames straight to a file descriptor, from its own
+    thread. put() only swaps in the newest frame, so a slow reader makes
+    frames get skipped instead of holding anyone up. Frames equal to the
+    previous one are skipped too. When the reader goes away on_close is
+    called, or if there is none, so do we.
+    '''
+    def __init__(self, encoder, fd=1, on_close=None, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'Output'
+        self.encoder = encoder
+        self.fd = fd
+        self.on_close = on_close
+        self.condition = Condition()
+        self.pending = None  # newest frame not written yet
+        self.last = None  # newest frame handed over
+        self.first = True
+        self.closed = False
+
+    def put(self, frame):
+        with self.condition:
+            if frame == self.last:
+                return
+            self.last = frame
+            self.pending = frame
+            self.condition.notify()
+
+    def flush(self):
+        '''Wait until everything handed over is written.'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending is None)
+
+    def close(self):
+        '''Stop writing, whatever is still pending is dropped.'''
+        with self.condition:
+            self.closed = True
+            self.pending = None
+            self.condition.notify_all()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def run(self):
+        try:
+            self._write(self.encoder.header)
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.pending is not None or self.closed)
+                    if self.closed:
+                        return
+                    frame = self.pending
+                if self.first:
+                    self.first = False
+                    self._write(frame + b'\n')
+                else:
+                    self._write(self.encoder.separator + frame + b'\n')
+                with self.condition:
+                    if self.pending is frame:
+                        self.pending = None
+                        self.condition.notify_all()
+        except OSError as e:
+            if self.on_close:
+                self.on_close()
+                return
+            if not isinstance(e, BrokenPipeError):
+                logging.exception('Caught exception in the output thread!')
+                self._exit(1)
+            logging.info('Output closed, exiting.')
+            self._exit(0)
+        except Exception as e:
+            logging.exception('Caught exception in the output thread!')
+            self._exit(1)
+
+    @staticmethod
+    def _exit(code):
+        # os._exit() skips atexit, write out the queued log records first
+        logging.shutdown()
+        os._exit(code)
+
+
+class BarClient():
+    '''
+    Lightweight bar process, prints whatever the daemon sends and passes
+    click events back to it.
+    '''
+    def __init__(self, path, order, encoder):
+        self.path = path
+        self.order = order
+        self.output = Output(encoder)
+        self.encoder = encoder
+        self.active = True
+        self.last = None
+        self.connection = None
+
+    def _sig_handler(self, sig):
+        if sig == signal.SIGUSR1:
+            self.active = False
+        elif sig == signal.SIGUSR2:
+            self.active = True
+            if self.last is not None:
+                self._print_data(self.last)
+
+    def _connect(self):
+        while True:
+            connection = socket(AF_UNIX)
+            try:
+                connection.connect(self.path)
+            except OSError:
+                connection.close()
+                sleep(1)
+            else:
+                connection.sendall(json.dumps(self.order).encode() + b'\n')
+                return connection
+
+    def _forward_clicks(self):
+        for event in sys.stdin:
+            try:
+                self.connection.sendall(event.encode())
+            except (OSError, AttributeError):
+                pass  # Daemon is away, drop the click
+
+    def _print_data(self, items):
+        self.output.put(self.encoder.encode(items))
+
+    def run(self):
+        self.output.start()
+        Thread(target=self._forward_clicks, daemon=True).start()
+        while True:
+            self.connection = self._connect()
+            with self.connection.makefile('r') as stream:
+                for line in stream:
+                    self.last = json.loads(line)
+                    if self.active:
+                        self._print_data(self.last)
+            self.connection.close()
+            self.connection = None
+
+
 class MPDCurrentSong(WorkerThread):
     '''
     Grabs current song from MPD. Shows data only if MPD is
@@ -332,12 +1199,14 @@ class MPDCurrentSong(WorkerThread):
         WorkerThread.__init__(self, **kwargs)
         self.host = host
         self.port = int(port)
+        self.template = self._template('{song}', 'song', 'artist', 'title')
         self.mpd_client = MPDClient()
         self._connect_to_mpd()
         self.commandq = Queue()
         observer.register_command('mpd', self.commandq)
         self.mpd_lock = Lock()
-        wait_for_commands = Thread(target=self._command_mangler, daemon=True)
+        wait_for_commands = Thread(target=self._command_mangler, daemon=True,
+                                   name=self.name + ' commands')
         wait_for_commands.start()
         if not self.is_stopped():
             self._playing()
@@ -357,33 +1226,54 @@ class MPDCurrentSong(WorkerThread):
             return False
 
     def _playing(self):
+        self.metrics['mpd_playing'] = 1
         if not self.show:
             self.show = True
 
     def _pausing(self):
+        self.metrics['mpd_playing'] = 0
         if self.show:
             self.show = False
 
+    def stop(self):
+        WorkerThread.stop(self)
+        try:
+            self.mpd_client.disconnect()
+        except Exception:
+            pass
+
     def _command_mangler(self):
         while True:
-            command = self.commandq.get()
+            commands = drain(self.commandq)
+            if self.stopped.is_set():
+                return
+            # The last skip wins, and only the toggles after it matter,
+            # cancelling out in pairs
+            skip = None
+            toggles = 0
+            for command in commands:
+                if command == 'next' or command == 'prev':
+                    skip = command
+                    toggles = 0
+                elif command == 'toggle':
+                    toggles += 1
             self.mpd_lock.acquire()
             try:
-                if command == 'toggle':
-                    if self.is_stopped():
-                        self.mpd_client.play()
-                        self._playing()
-                    else:
-                        self.mpd_client.pause()
-                        self._pausing()
-                elif command == 'next' or command == 'prev':
-                    if command == 'next':
+                if skip:
+                    if skip == 'next':
                         self.mpd_client.next()
                     else:
                         self.mpd_client.previous()
                     if self.is_stopped():
                         self.mpd_client.play()
                         self._playing()
+                if toggles % 2:
+                    if self.is_stopped():
+                        self.mpd_client.play()
+                        self._playing()
+                    else:
+                        self.mpd_client.pause()
+                        self._pausing()
 
             except:
                 self.show = False
@@ -396,7 +1286,7 @@ class MPDCurrentSong(WorkerThread):
 
     def _update_data(self):
         '''
-        Updates self._data to a string in a format "Artist - Song"
+        Updates full_text to a string in a format "Artist - Song"
         '''
         # If mpd has been stopped from outside of this script, this should catch it.
         if self.is_stopped():
@@ -417,11 +1307,14 @@ class MPDCurrentSong(WorkerThread):
                 else:
                     mpd_title = ''
                 if mpd_artist and mpd_title:
-                    self._data['full_text'] = mpd_artist + ' - ' + mpd_title
+                    mpd_song = mpd_artist + ' - ' + mpd_title
                 elif not mpd_artist and not mpd_title:
-                    self._data['full_text'] = 'Unknown'
+                    mpd_song = 'Unknown'
                 else:
-                    self._data['full_text'] = mpd_artist + mpd_title # one is empty, so it doesn't matter
+                    mpd_song = mpd_artist + mpd_title # one is empty, so it doesn't matter
+                self._set(full_text=self.template.render(song=mpd_song,
+                                                         artist=mpd_artist,
+                                                         title=mpd_title))
             except (ConnectionError, ConnectionRefusedError):
                 self._connect_to_mpd()
             finally:
@@ -479,32 +1372,191 @@ class GPUTemp(GetTemp):
         temp = self.extractor(output)
         self._check_temp(temp)
         
+Sensor = namedtuple('Sensor', 'chip label path critical')
+
+
+class HwmonIndex():
+    '''
+    Every temperature sensor in /sys/class/hwmon, with its chip name,
+    label and critical threshold. Shared by all HwmonTemp threads, and
+    rebuilt when the hwmon devices change.
+    '''
+    root = '/sys/class/hwmon'
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self):
+        self.sensors = []
+        self.devices = None
+        self.generation = 0  # bumped on every rescan
+        self.lock = Lock()
+        self.refresh()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def forget_shared(cls):
+        cls._shared = None
+        cls._shared_lock = Lock()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as attribute:
+                return attribute.read().strip()
+        except OSError:
+            return None
+
+    def refresh(self):
+        '''
+        Rescan if hwmon devices were added or removed, returns True
+        if so. Costs a single directory listing otherwise.
+        '''
+        try:
+            devices = sorted(os.listdir(self.root))
+        except OSError:
+            devices = []
+        with self.lock:
+            if devices == self.devices:
+                return False
+            self.devices = devices
+            self._scan()
+            return True
+
+    def _scan(self):
+        sensors = []
+        for device in self.devices:
+            path = os.path.join(self.root, device)
+            # Older drivers keep their attributes in device/
+            for directory in (path, os.path.join(path, 'device')):
+                chip = self._read(os.path.join(directory, 'name'))
+                if chip:
+                    break
+            else:
+                continue
+            for temp_input in sorted(glob(os.path.join(directory, 'temp*_input'))):
+                prefix = temp_input[:-len('_input')]
+                label = (self._read(prefix + '_label') or
+                         os.path.basename(prefix))
+                critical = self._read(prefix + '_crit')
+                critical = float(critical) / 1000 if critical else None
+                sensors.append(Sensor(chip, label, temp_input, critical))
+        self.sensors = sensors
+        self.generation += 1
+        logging.info('Found %d hwmon temperature sensors.', len(sensors))
+
+    def select(self, patterns):
+        '''
+        Sensors matching any of the 'chip:label' glob patterns, label
+        defaults to all of them.
+        '''
+        selected = []
+        for sensor in self.sensors:
+            for pattern in patterns:
+                chip, _, label = pattern.partition(':')
+                if fnmatch(sensor.chip, chip) and fnmatch(sensor.label, label or '*'):
+                    selected.append(sensor)
+                    break
+        return selected
+
+
+# Worker processes must not wait on locks held by threads that didn't
+# make it through the fork, they build their own.
+os.register_at_fork(after_in_child=HwmonIndex.forget_shared)
+
+
 class HwmonTemp(GetTemp):
     '''
-    Reads temperature from every file specified in temp_files list
-    and displays the highest one. Altough this class is supposed to deal
-    with CPU temperatures, any temperature file from hwmon driver should
-    work.
+    Reads temperature from every file specified in temp_files list,
+    and every sensor matching sensors patterns ('chip:label' globs, e.g.
+    coretemp:Core*), and displays the highest one. Altough this class is
+    supposed to deal with CPU temperatures, any temperature file from
+    hwmon driver should work. With temp_critical = auto, the lowest
+    critical threshold of the sensors is used.
     '''
-    def __init__(self, temp_files, **kwargs):
+    def __init__(self, temp_files='', sensors='', rescan_interval=60, **kwargs):
+        self.auto_critical = kwargs.get('temp_critical') == 'auto'
+        if self.auto_critical:
+            kwargs['temp_critical'] = 'inf'
         GetTemp.__init__(self, **kwargs)
         self.temp_files = temp_files.split()
-        
+        self.patterns = sensors.split()
+        self.index = HwmonIndex.shared() if self.patterns else None
+        self.generation = None
+        self.rescan_interval = float(rescan_interval)
+        self.next_rescan = time() + self.rescan_interval
+        # Files are kept open and re-read from the start every time
+        self.descriptors = []
+        # stop() closes the descriptors from another thread
+        self.descriptors_lock = Lock()
+        self._resolve()
+
+    def _resolve(self):
+        '''(Re)open the files to poll.'''
+        with self.descriptors_lock:
+            self._close()
+            if not self.stopped.is_set():
+                self._open()
+
+    def _close(self):
+        for descriptor in self.descriptors:
+            os.close(descriptor)
+        self.descriptors = []
+
+    def _open(self):
+        temp_files = list(self.temp_files)
+        if self.index:
+            self.generation = self.index.generation
+            sensors = self.index.select(self.patterns)
+            if not sensors:
+                logging.warning('%s: No sensors matching %s.', self.name, ' '.join(self.patterns))
+            temp_files.extend(sensor.path for sensor in sensors)
+            if self.auto_critical:
+                thresholds = [sensor.critical for sensor in sensors if sensor.critical]
+                self.temp_critical = min(thresholds) if thresholds else float('inf')
+        for temp_file in temp_files:
+            try:
+                self.descriptors.append(os.open(temp_file, os.O_RDONLY))
+            except OSError:
+                logging.warning('%s: Can\'t open %s.', self.name, temp_file)
+
     def _update_data(self):
+        if self.index and time() >= self.next_rescan:
+            self.next_rescan = time() + self.rescan_interval
+            self.index.refresh()
+        if self.index and self.generation != self.index.generation:
+            self._resolve()
+
         max_temp = 0
-        for temp_file in self.temp_files:
-            with open(temp_file) as temp_output:
-                temp = float(temp_output.read())
+        try:
+            with self.descriptors_lock:
+                temps = [float(os.pread(descriptor, 32, 0))
+                         for descriptor in self.descriptors]
+            for temp in temps:
+                # if temp is higer than 1000, 
+                # assume it's in milidegrees of Celsius
+                if temp > 1000:
+                    temp = float(temp) / 1000
                 
-            # if temp is higer than 1000, 
-            # assume it's in milidegrees of Celsius
-            if temp > 1000:
-                temp = float(temp) / 1000
-            
-            if temp > max_temp:
-                max_temp = temp
+                if temp > max_temp:
+                    max_temp = temp
+        except OSError:
+            # Device went away, look for it again next time
+            if not (self.index and self.index.refresh()):
+                self._resolve()
+            raise
         self._check_temp(max_temp)
 
+    def stop(self):
+        WorkerThread.stop(self)
+        with self.descriptors_lock:
+            self._close()
+
         
 class DiskUsage(WorkerThread):
     '''
@@ -516,6 +1568,9 @@ class DiskUsage(WorkerThread):
         WorkerThread.__init__(self, **kwargs)
         self.percentage = float(percentage)
         self.mountpoint = mountpoint
+        self.template = self._template('{mountpoint}: {percent}% {free!h}[ {spark}]',
+                                       'mountpoint', 'percent', 'free', 'used',
+                                       'total', *TREND_FIELDS)
         
     def _update_data(self):
         try:
@@ -524,43 +1579,33 @@ class DiskUsage(WorkerThread):
             self.show = False
             pass
         else:
+            self._record(usage.percent)
+            self.metrics['disk_used_percent'] = usage.percent
+            self.metrics['disk_free_bytes'] = usage.free
             if usage.percent > self.percentage:
-                self.urgent = True
-                self._data['full_text'] = '{}: {}% {}'.format(
-                    self.mountpoint, 
-                    usage.percent,
-                    self.human_size(usage.free))
-                self._data['color'] = self.color_warning
-                self.show = True
+                self._set(full_text=self.template.render(
+                              mountpoint=self.mountpoint,
+                              percent=usage.percent,
+                              free=usage.free,
+                              used=usage.used,
+                              total=usage.total,
+                              **self._trend(self.template)),
+                          color=self.color_warning,
+                          urgent=True,
+                          show=True)
             else:
-                self.show = False
-                self.urgent = False
+                self._set(show=False, urgent=False)
 
-    def human_size(self, byte):
-        '''
-        Present amount of bytes in human-readable format.
-        '''
-        if byte == 0:
-            return '0.0 B'
-        suffixes = ('B', 'K', 'M', 'G', 'T', 'P')
-        values = {}
-        for n, suffix in enumerate(suffixes):
-            values[suffix] = pow(2, (n*10))
-        for suffix in reversed(suffixes):
-            if byte >= values[suffix]:
-                value = byte / values[suffix]
-                value = '{:.1f} {}'.format(value, suffix)
-                return value
-            
 class Date(WorkerThread):
     '''Shows date and time, nothing to see here.'''
     def __init__(self, representation, **kwargs):
         WorkerThread.__init__(self, **kwargs)
         self.show = True
         self.representation = representation
+        self.template = self._template('{time}', 'time')
     
     def _update_data(self):
-        self._data['full_text'] = strftime(self.representation)
+        self._set(full_text=self.template.render(time=strftime(self.representation)))
 
     
 class BatteryStatus(WorkerThread):
@@ -581,6 +1626,8 @@ class BatteryStatus(WorkerThread):
         self.battery_file_present = battery_file_present
         self.battery_file_charge = battery_file_charge
         self.battery_file_status = battery_file_status
+        self.template = self._template('{status} {percentage:.0f}%[ {spark}]',
+                                       'status', 'percentage', *TREND_FIELDS)
         
     def _update_data(self):
         with open(self.battery_file_present) as bat_p:
@@ -603,15 +1650,16 @@ class BatteryStatus(WorkerThread):
                 charge = int(bat_c.read().strip())
                 
             percentage = charge * 100 / full
-            if percentage < self.critical:
-                self.urgent = True
-                self._data['color'] = self.color_critical
-            else:
-                self.urgent = False
-                self._data['color'] = self.color_normal
-            self._data['full_text'] = '{} {:.0f}%'.format(status, 
-                percentage)
-            self.show = True
+            self._record(percentage)
+            self.metrics['battery_percent'] = percentage
+            self.metrics['battery_charging'] = int(status == 'Charging')
+            critical = percentage < self.critical
+            self._set(full_text=self.template.render(status=status,
+                                                     percentage=percentage,
+                                                     **self._trend(self.template)),
+                      color=self.color_critical if critical else self.color_normal,
+                      urgent=critical,
+                      show=True)
         
         elif status == 'Unknown':
             self.show = False
@@ -622,9 +1670,12 @@ class WirelessStatus(WorkerThread):
     Monitor if given interface is connected to the internet. Uses ioctl()
     call.
     '''
-    def __init__(self, interface, **kwargs):
+    def __init__(self, interface, format_disconnected=None, **kwargs):
         WorkerThread.__init__(self, **kwargs)
         self.interface = interface
+        self.template = self._template('{essid}', 'essid', 'interface')
+        self.template_disconnected = Template(format_disconnected or '{interface} disconnected',
+                                              ('interface',))
         self.length = 32 # Max ESSID length
         self.fmt = 'PB' # Format for struct.pack(), P = void*, B=unsigned char
         self.magic_number = 0x8B1B # Wizardry
@@ -643,15 +1694,17 @@ class WirelessStatus(WorkerThread):
         ioctl(self.kernel_socket.fileno(), self.magic_number, self.iwrequest)
         output = self.essid.tostring().strip(b'\x00').decode()
         
+        self.metrics['wireless_connected'] = int(bool(output))
+        self.metrics['wireless_essid'] = output
         if output:
-            self._data['full_text'] = output
-            self._data['color'] = self.color_normal
-            self.urgent = False
+            self._set(full_text=self.template.render(essid=output,
+                                                     interface=self.interface),
+                      color=self.color_normal,
+                      urgent=False)
         else:
-            self._data['full_text'] = '{} disconnected'.format(
-                self.interface)
-            self._data['color'] = self.color_critical
-            self.urgent = True
+            self._set(full_text=self.template_disconnected.render(interface=self.interface),
+                      color=self.color_critical,
+                      urgent=True)
         
         # Regenerate for reuse
         # memset essid to zeros
@@ -690,6 +1743,8 @@ class Volume(WorkerThread):
         self.step = int(step)
         self.getvolre = re.compile(r'\[(?P<volume>[0-9]*)%\]')
         self.getmutere = re.compile(r'\[(?P<mute>on|off)\]')
+        self.template = self._template('♪:{volume:3d}%[ {spark}]',
+                                       'volume', 'muted', *TREND_FIELDS)
         self.pausable = False                    
         self._update_volume()
         self.show = True
@@ -726,18 +1781,14 @@ class Volume(WorkerThread):
         
         
     def _update_data(self):
-        command = self.commandq.get()
-        if command == 'up' or command == 'down':
-            volume = self.getvolume()
-            if command == 'up':
-                new_volume = volume + self.step
-            
-            elif command == 'down':
-                new_volume = volume - self.step
-            
-            self.setvolume(new_volume)
+        # Sum up the steps and mutes cancel out in pairs, so a burst
+        # costs the same as a single press
+        commands = drain(self.commandq)
+        steps = commands.count('up') - commands.count('down')
+        if steps:
+            self.setvolume(self.getvolume() + steps * self.step)
         
-        elif command == 'mute':
+        if commands.count('mute') % 2:
             self.togmute()
         
         self._update_volume()
@@ -745,13 +1796,212 @@ class Volume(WorkerThread):
     def _update_volume(self):
         muted = self.is_muted()
         volume = self.getvolume()
-        self._data['full_text'] = '♪:{:3d}%'.format(volume)
-        if muted:
-            self._data['color'] = self.color_critical
-        else:
-            self._data['color'] = self.color_normal
+        self._record(volume)
+        self.metrics['volume_percent'] = volume
+        self.metrics['volume_muted'] = int(muted)
+        self._set(full_text=self.template.render(volume=volume, muted=muted,
+                                                 **self._trend(self.template)),
+                  color=self.color_critical if muted else self.color_normal)
 
         
+class ProcSampler():
+    '''
+    Reads /proc/stat, /proc/meminfo and /proc/net/dev for every thread
+    that needs them. The files are kept open, read at most once per
+    max_age seconds however many threads ask, and only the parts asked
+    for get parsed.
+    '''
+    files = {'stat': '/proc/stat',
+             'meminfo': '/proc/meminfo',
+             'netdev': '/proc/net/dev'
+             }
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self, max_age=0.9):
+        self.max_age = max_age
+        self.descriptors = {}
+        self.contents = {}
+        self.read_at = {}
+        self.lock = Lock()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def forget_shared(cls):
+        cls._shared = None
+        cls._shared_lock = Lock()
+
+    def _read(self, name):
+        with self.lock:
+            now = monotonic()
+            if now - self.read_at.get(name, -self.max_age) < self.max_age:
+                return self.contents[name]
+            if name not in self.descriptors:
+                self.descriptors[name] = os.open(self.files[name], os.O_RDONLY)
+            descriptor = self.descriptors[name]
+            chunks = []
+            offset = 0
+            while True:
+                chunk = os.pread(descriptor, 65536, offset)
+                chunks.append(chunk)
+                if len(chunk) < 65536:
+                    break
+                offset += len(chunk)
+            self.contents[name] = b''.join(chunks)
+            self.read_at[name] = now
+            return self.contents[name]
+
+    def cpu(self, times):
+        '''
+        Fill times (an array of 8) with total CPU times from the first
+        line of /proc/stat: user nice system idle iowait irq softirq steal.
+        '''
+        stat = self._read('stat')
+        for i, value in enumerate(stat[:stat.index(b'\n')].split()[1:9]):
+            times[i] = int(value)
+
+    def meminfo(self, fields):
+        '''Returns given /proc/meminfo fields, in bytes.'''
+        values = {}
+        for line in self._read('meminfo').splitlines():
+            key, _, value = line.partition(b':')
+            key = key.decode()
+            if key in fields:
+                values[key] = int(value.split()[0]) * 1024
+                if len(values) == len(fields):
+                    break
+        return values
+
+    def netdev(self, interface, counters):
+        '''
+        Fill counters (an array of 2) with bytes received and sent by
+        the interface. Returns False if there is no such interface.
+        '''
+        name = interface.encode()
+        for line in self._read('netdev').splitlines()[2:]:
+            key, _, values = line.partition(b':')
+            if key.strip() == name:
+                values = values.split()
+                counters[0] = int(values[0])
+                counters[1] = int(values[8])
+                return True
+        return False
+
+
+os.register_at_fork(after_in_child=ProcSampler.forget_shared)
+
+
+class CPULoad(WorkerThread):
+    '''
+    Shows CPU usage since the last check, from /proc/stat. Turns urgent
+    above warning percent.
+    '''
+    def __init__(self, warning=90, **kwargs):
+        WorkerThread.__init__(self, **kwargs)
+        self.warning = float(warning)
+        self.sampler = ProcSampler.shared()
+        self.template = self._template('{name}: {percent:3.0f}%[ {spark}]',
+                                       'name', 'percent', *TREND_FIELDS)
+        self.times = array('Q', [0]) * 8
+        self.previous = array('Q', [0]) * 8
+        self.sampler.cpu(self.previous)
+        self.show = True
+
+    def _update_data(self):
+        self.sampler.cpu(self.times)
+        total = idle = 0
+        for i in range(8):
+            delta = self.times[i] - self.previous[i]
+            total += delta
+            if i == 3 or i == 4:  # idle and iowait
+                idle += delta
+            self.previous[i] = self.times[i]
+        if not total:
+            return
+        percent = 100 * (total - idle) / total
+        self._record(percent)
+        self.metrics['cpu_percent'] = percent
+        urgent = percent >= self.warning
+        self._set(full_text=self.template.render(name=self.name, percent=percent,
+                                                 **self._trend(self.template)),
+                  color=self.color_warning if urgent else self.color_normal,
+                  urgent=urgent)
+
+
+class MemoryUsage(WorkerThread):
+    '''
+    Shows memory in use, from /proc/meminfo. Turns urgent above
+    warning percent.
+    '''
+    def __init__(self, warning=90, **kwargs):
+        WorkerThread.__init__(self, **kwargs)
+        self.warning = float(warning)
+        self.sampler = ProcSampler.shared()
+        self.fields = ('MemTotal', 'MemAvailable')
+        self.template = self._template('{name}: {used!h}[ {spark}]',
+                                       'name', 'used', 'available', 'total',
+                                       'percent', *TREND_FIELDS)
+        self.show = True
+
+    def _update_data(self):
+        memory = self.sampler.meminfo(self.fields)
+        total = memory['MemTotal']
+        available = memory['MemAvailable']
+        used = total - available
+        percent = 100 * used / total
+        self._record(percent)
+        self.metrics['memory_used_bytes'] = used
+        self.metrics['memory_percent'] = percent
+        urgent = percent >= self.warning
+        self._set(full_text=self.template.render(name=self.name, used=used,
+                                                 available=available,
+                                                 total=total, percent=percent,
+                                                 **self._trend(self.template)),
+                  color=self.color_warning if urgent else self.color_normal,
+                  urgent=urgent)
+
+
+class NetworkThroughput(WorkerThread):
+    '''
+    Shows how fast the interface receives and sends data, from
+    /proc/net/dev. Hidden when the interface doesn't exist.
+    '''
+    def __init__(self, interface, **kwargs):
+        WorkerThread.__init__(self, **kwargs)
+        self.interface = interface
+        self.sampler = ProcSampler.shared()
+        self.template = self._template('{interface}: {down!h}/s {up!h}/s',
+                                       'interface', 'down', 'up')
+        self.counters = array('Q', [0, 0])
+        self.previous = array('Q', [0, 0])
+        self.checked = None
+
+    def _update_data(self):
+        now = monotonic()
+        if not self.sampler.netdev(self.interface, self.counters):
+            self.checked = None
+            self.show = False
+            return
+        if self.checked is not None and now > self.checked:
+            elapsed = now - self.checked
+            # Counters start over when the interface comes back
+            down = max(self.counters[0] - self.previous[0], 0) / elapsed
+            up = max(self.counters[1] - self.previous[1], 0) / elapsed
+            self.metrics['network_receive_bytes_per_second'] = down
+            self.metrics['network_transmit_bytes_per_second'] = up
+            self._set(full_text=self.template.render(interface=self.interface,
+                                                     down=down, up=up),
+                      show=True)
+        self.previous[0], self.previous[1] = self.counters
+        self.checked = now
+
+
 class XInfo(WorkerThread):
     '''
     I need to come up with a better solution, but this will do for now.
@@ -761,23 +2011,23 @@ class XInfo(WorkerThread):
         WorkerThread.__init__(self, **kwargs)
         self.command = 'xset q'.split()
         self.lock_keys_re = re.compile(r'(Caps Lock|Num Lock|Scroll Lock):\s*(off|on)')
-        self._data['color'] = self.color_warning
+        self._set(color=self.color_warning)
+        self.template = self._template('{keys}', 'keys')
         
     def _update_data(self):
         xset = Popen(self.command, stdout=PIPE)
         output = xset.stdout.read().decode()
-        self._data['full_text'] = ''
+        keys = []
         
         for match in self.lock_keys_re.finditer(output):
             key, state = match.groups()
             if state == 'on':
-                self._data['full_text'] += key + ' '
+                keys.append(key)
         
-        if self._data['full_text']:
-            self._data['full_text'] = self._data['full_text'].strip()
-            self.show = True
+        if keys:
+            self._set(full_text=self.template.render(keys=' '.join(keys)), show=True)
         else:
-            self.show = False
+            self._set(show=False)
             
         
 class DPMS(Toggler):
@@ -825,90 +2075,745 @@ class TouchPad(Toggler):
         self.show = False
 
     
+class MetricsServer(Thread):
+    '''
+    Serves the latest readings on a Unix socket, so other tools don't
+    have to sample the same things again. Nothing gets sampled on
+    request. Clients may send 'json' for JSON lines, anything else
+    (or nothing) gets Prometheus text format.
+    '''
+    def __init__(self, path, statusbar, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'MetricsServer'
+        self.path = path
+        self.statusbar = statusbar
+        self.listener = socket(AF_UNIX)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.listener.bind(self.path)
+        self.listener.listen(5)
+
+    def _readings(self):
+        '''Yields (section, name, readings) for every running section.'''
+        with self.statusbar.lock:
+            sections = [(entry, self.statusbar.threads[entry], self.statusbar.data.get(entry))
+                        for entry in self.statusbar.order if entry in self.statusbar.threads]
+        for entry, thread, output in sections:
+            readings = {'block_shown': int(bool(output)),
+                        'block_urgent': int(bool(output and output.get('urgent')))}
+            readings.update(getattr(thread, 'metrics', {}).copy())
+            yield entry, thread.name, readings
+
+    def json_lines(self):
+        lines = []
+        for entry, name, readings in self._readings():
+            readings['section'] = entry
+            readings['name'] = name
+            lines.append(json.dumps(readings) + '\n')
+        return ''.join(lines)
+
+    @staticmethod
+    def _label(value):
+        '''Quoted label value, escaped the way Prometheus expects.'''
+        return '"{}"'.format(str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+
+    def prometheus(self):
+        # Samples of a metric have to be listed together
+        families = {}  # metric name: [sample lines]
+        for entry, name, readings in self._readings():
+            section = self._label(entry)
+            for metric, value in readings.items():
+                if isinstance(value, str):
+                    metric = 'py3status_{}_info'.format(metric)
+                    sample = '{}{{section={},value={}}} 1\n'.format(
+                        metric, section, self._label(value))
+                else:
+                    metric = 'py3status_{}'.format(metric)
+                    sample = '{}{{section={}}} {}\n'.format(metric, section, value)
+                families.setdefault(metric, []).append(sample)
+        lines = []
+        for metric, samples in sorted(families.items()):
+            lines.append('# TYPE {} gauge\n'.format(metric))
+            lines.extend(samples)
+        return ''.join(lines)
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+                with connection:
+                    connection.settimeout(0.2)
+                    try:
+                        request = connection.recv(64).strip().lower()
+                    except OSError:
+                        request = b''
+                    if request == b'json':
+                        response = self.json_lines()
+                    else:
+                        response = self.prometheus()
+                    connection.sendall(response.encode())
+            except Exception as e:
+                logging.exception('Caught exception in the metrics server!')
+
+
+class LogThrottle(logging.Filter):
+    '''
+    Keeps error bursts from flooding the log. Repeats of the same message
+    (and traceback) are dropped for repeat_interval seconds, and no more
+    than rate records per second get through overall. Runs before the
+    record is queued, so dropped records cost next to nothing.
+    '''
+    def __init__(self, rate, repeat_interval):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.repeat_interval = float(repeat_interval)
+        self.allowance = self.rate
+        self.checked = time()
+        self.seen = {}  # key: [time of last logged record, suppressed count]
+        self.dropped = 0
+        self.lock = Lock()
+
+    def _key(self, record):
+        key = [record.name, record.levelno, str(record.msg), repr(record.args)]
+        if record.exc_info and record.exc_info[0]:
+            tb = record.exc_info[2]
+            while tb and tb.tb_next:
+                tb = tb.tb_next
+            key.append(record.exc_info[0])
+            if tb:
+                key.extend((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+        elif record.exc_text:
+            # Relayed from a worker process, only the text is left
+            key.append(record.exc_text)
+        return tuple(key)
+
+    def filter(self, record):
+        now = time()
+        key = self._key(record)
+        with self.lock:
+            seen = self.seen.get(key)
+            if seen and now - seen[0] < self.repeat_interval:
+                seen[1] += 1
+                return False
+
+            self.allowance = min(self.rate,
+                                 self.allowance + (now - self.checked) * self.rate)
+            self.checked = now
+            if self.allowance < 1:
+                self.dropped += 1
+                return False
+            self.allowance -= 1
+
+            suppressed = seen[1] if seen else 0
+            if len(self.seen) > 1000:
+                self.seen = {k: v for k, v in self.seen.items()
+                             if now - v[0] < self.repeat_interval}
+            self.seen[key] = [now, 0]
+            dropped, self.dropped = self.dropped, 0
+
+        if suppressed or dropped:
+            record.msg = '{} ({} repeats, {} other messages dropped)'.format(
+                record.msg, suppressed, dropped)
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records to a writer thread as they are, formatting happens
+    there too. When the queue is full the record is dropped, rather than
+    making the caller wait. Closing it, which logging.shutdown() does at
+    exit, writes out whatever is still queued.
+    '''
+    def __init__(self, writer, maxsize=1000):
+        logging.handlers.QueueHandler.__init__(self, Queue(maxsize=maxsize))
+        self.writer = writer
+        self.listener = None
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue, self.writer)
+        self.listener.start()
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener:
+            listener.stop()  # drains the queue first
+        logging.handlers.QueueHandler.close(self)
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            pass
+
+
+class Profiler(Thread):
+    '''
+    Sampling profiler for finding out what eats the CPU. 'profile:start 30'
+    sent to the FIFO samples stacks of every thread for 30 seconds,
+    'profile:stop' ends it early. Results go to a collapsed-stack file
+    flamegraph tools can read. Sleeps on its queue until then, so it costs
+    nothing when not in use.
+    '''
+    def __init__(self, observer, interval, directory, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'Profiler'
+        self.interval = float(interval)
+        self.directory = directory
+        self.commandq = Queue()
+        observer.register_command('profile', self.commandq)
+
+    def run(self):
+        while True:
+            command = self.commandq.get().split()
+            try:
+                if command and command[0] == 'start':
+                    duration = float(command[1]) if len(command) > 1 else 30
+                    self._write(self._profile(duration))
+            except Exception as e:
+                logging.exception('Caught exception in the profiler!')
+
+    def _profile(self, duration):
+        logging.info('Profiling for %s seconds.', duration)
+        stacks = {}
+        me = get_ident()
+        end = time() + duration
+        while time() < end:
+            names = {thread.ident: thread.name for thread in threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name,
+                                                     os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack = ';'.join(reversed(stack))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            # Waiting for 'stop' doubles as the sampling timer
+            try:
+                if self.commandq.get(timeout=self.interval).strip() == 'stop':
+                    break
+            except Empty:
+                pass
+        return stacks
+
+    def _write(self, stacks):
+        path = os.path.join(self.directory,
+                            strftime('py3status-profile-%Y%m%d-%H%M%S.folded'))
+        with open(path, 'w') as output:
+            for stack, count in sorted(stacks.items()):
+                output.write('{} {}\n'.format(stack, count))
+        logging.warning('Profile written to %s', path)
+
+
+class Recorder():
+    '''
+    Writes a trace of everything going in and out of the StatusBar, one
+    JSON object per line, with seconds since the start in 't':
+    order - sections shown, in order, and those restarted by a reload
+    update - output of a section, as sent by its thread
+    pause, resume - i3bar hid or showed the bar
+    refresh - refresh_all() asked these sections to report at once
+    timeout - gave up waiting for the rest of them
+    command - command sent to the FIFO
+    click - click event from i3bar
+    frame - line printed to i3bar, or sent to clients in daemon mode
+    '''
+    def __init__(self, path):
+        self.output = open(path, 'w')
+        self.start = monotonic()
+        self.lock = Lock()
+
+    def record(self, kind, **fields):
+        fields['t'] = round(monotonic() - self.start, 6)
+        fields['kind'] = kind
+        line = json.dumps(fields) + '\n'
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+
+
+class Replayer(Thread):
+    '''
+    Feeds a recording made by Recorder back into a StatusBar in place of
+    its threads, either at the recorded pace or as fast as possible.
+    Commands and clicks are only counted, running them would touch the
+    hardware. Frames printed are compared with the recorded ones.
+    Everything but updates waits for the updates before it to be handled,
+    as it would have.
+    '''
+    def __init__(self, path, statusbar, fast=False, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'Replayer'
+        self.path = path
+        self.statusbar = statusbar
+        self.fast = fast
+        self.counts = {}
+        self.expected = []
+        self.frames = []
+
+    def record(self, kind, **fields):
+        # Stands in for the Recorder of the StatusBar being replayed into
+        if kind == 'frame':
+            self.frames.append(fields['frame'])
+
+    def run(self):
+        start = monotonic()
+        with open(self.path) as recording:
+            for line in recording:
+                entry = json.loads(line)
+                kind = entry['kind']
+                self.counts[kind] = self.counts.get(kind, 0) + 1
+                if not self.fast:
+                    delay = start + entry['t'] - monotonic()
+                    if delay > 0:
+                        sleep(delay)
+                if kind == 'update':
+                    self.statusbar.updates.put((entry['section'], entry['output']))
+                elif kind == 'frame':
+                    self.expected.append(entry['frame'])
+                else:
+                    self.statusbar.updates.join()
+                    self._apply(kind, entry)
+        # Tells _handle_updates to finish
+        self.statusbar.updates.put((None, None))
+
+    def _apply(self, kind, entry):
+        statusbar = self.statusbar
+        with statusbar.lock:
+            if kind == 'order':
+                for section in entry.get('restarted', []):
+                    statusbar.data.pop(section, None)
+                statusbar.order = entry['order']
+                statusbar.sections = dict.fromkeys(entry['order'], {})
+            elif kind == 'pause':
+                statusbar.active = False
+                return
+            elif kind == 'resume':
+                statusbar.active = True  # the refresh that follows prints
+                return
+            elif kind == 'refresh':
+                # Only a recorded timeout ends the wait, not the clock
+                statusbar.pending = set(entry['sections'])
+                statusbar.refresh_deadline = None
+            elif kind == 'timeout':
+                statusbar.pending.clear()
+            else:
+                return
+            if statusbar.active and not statusbar.pending:
+                statusbar._print_data()
+
+    def report(self, elapsed):
+        mismatched = sum(1 for expected, frame in zip(self.expected, self.frames)
+                         if expected != frame)
+        mismatched += abs(len(self.expected) - len(self.frames))
+        print('Replayed {} in {:.3f}s, {} frames printed, {} recorded, {} differ'.format(
+            ', '.join('{} {}'.format(count, kind) for kind, count in sorted(self.counts.items())),
+            elapsed, len(self.frames), len(self.expected), mismatched),
+            file=sys.stderr)
+        return mismatched
+
+
+class ClockWatcher(Thread):
+    '''
+    Notices the system coming back from suspend, or the wall clock being
+    set, by comparing clocks every interval seconds. CLOCK_MONOTONIC
+    stops during suspend, CLOCK_BOOTTIME and the wall clock don't.
+    '''
+    def __init__(self, statusbar, interval=5, threshold=2, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'ClockWatcher'
+        self.statusbar = statusbar
+        self.interval = float(interval)
+        self.threshold = float(threshold)
+
+    @staticmethod
+    def _clocks():
+        return (monotonic(),
+                clock_gettime(CLOCK_BOOTTIME),
+                time())
+
+    def run(self):
+        previous = self._clocks()
+        while True:
+            sleep(self.interval)
+            clocks = self._clocks()
+            elapsed = clocks[0] - previous[0]
+            if (abs(clocks[1] - previous[1] - elapsed) > self.threshold or
+                    abs(clocks[2] - previous[2] - elapsed) > self.threshold):
+                logging.info('Clock jumped, suspended? Refreshing everything.')
+                try:
+                    self.statusbar.refresh_all()
+                except Exception as e:
+                    logging.exception('Caught exception in the clock watcher!')
+            previous = clocks
+
+
+class ConfigWatcher(Thread):
+    '''
+    Reloads the StatusBar config when one of the config files changes,
+    or when asked to with 'py3status:reload' sent to the FIFO.
+    '''
+    def __init__(self, statusbar, observer, interval, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.name = 'ConfigWatcher'
+        self.statusbar = statusbar
+        self.interval = float(interval)
+        self.commandq = Queue()
+        observer.register_command('py3status', self.commandq)
+        self.mtimes = self._mtimes()
+
+    def _mtimes(self):
+        mtimes = {}
+        for config_file in self.statusbar.config_files:
+            try:
+                mtimes[config_file] = os.stat(config_file).st_mtime
+            except OSError:
+                mtimes[config_file] = None
+        return mtimes
+
+    def run(self):
+        while True:
+            try:
+                # Waiting for commands doubles as the polling timer
+                command = self.commandq.get(timeout=self.interval)
+            except Empty:
+                command = None
+            try:
+                mtimes = self._mtimes()
+                if command == 'reload' or mtimes != self.mtimes:
+                    self.mtimes = mtimes
+                    self.statusbar.reload()
+            except Exception as e:
+                logging.exception('Caught exception while reloading config!')
+
+
 class StatusBar():
-    def __init__(self):
-        self.threads = []
+    # Options in [DEFAULT] meant for py3status itself rather than the
+    # threads, with their defaults
+    settings = {'logfile': '/tmp/py3status.log',
+                'loglevel': 'warning',
+                'log_max_bytes': '1048576',
+                'log_backups': '1',
+                'log_rate': '10',
+                'log_repeat_interval': '60',
+                'reload_interval': '2',
+                'metrics_socket': '',
+                'profile_interval': '0.01',
+                'refresh_timeout': '1'
+                }
+
+    def __init__(self, socket_path=None, recorder=None, encoder=None):
+        # Running threads, by config section
+        self.threads = {}
         # Holds the last known output of threads
-        self.data = []
-        self.comma = ''
+        self.data = {}
+        # Sections to show, in order
+        self.order = []
+        # Options every running thread was started with, to spot changes
+        self.sections = {}
+        self.config_files = []
+        # Guards the above against a reload from the watcher thread
+        self.lock = RLock()
+        # In daemon mode output goes to the socket instead of stdout
+        self.socket_path = socket_path
+        self.server = None
+        self.recorder = recorder
+        self.encoder = encoder or I3barEncoder()
+        self.output = None
         self.updates = Queue()
+        # Sections yet to report after refresh_all(), output waits for
+        # them until refresh_deadline to go out as a single frame
+        self.pending = set()
+        self.refresh_deadline = 0
+        self.refresh_timeout = float(self.settings['refresh_timeout'])
         self.process = psutil.Process(os.getpid())
         self.process.set_nice(5)
         self.process.set_ionice(psutil.IOPRIO_CLASS_IDLE)
         self.active = True
 
     def _sig_handler(self, sig):
-        for thread in self.threads:
-            thread.handle(sig)
-        if sig == signal.SIGUSR1:
-            self.active = False
-        elif sig == signal.SIGUSR2:
-            self.active = True
-            self._print_data()
+        with self.lock:
+            for thread in self.threads.values():
+                thread.handle(sig)
+            if sig == signal.SIGUSR1:
+                self.active = False
+                if self.recorder:
+                    self.recorder.record('pause')
+            elif sig == signal.SIGUSR2:
+                self.active = True
+                if self.recorder:
+                    self.recorder.record('resume')
+                self.refresh_all()
+
+    def refresh_all(self):
+        '''
+        Make every thread report right away, and print them all in one
+        frame, or whatever is there after refresh_timeout. While the bar
+        is hidden, paused threads are left alone, resuming refreshes them.
+        '''
+        with self.lock:
+            refreshed = {entry: thread for entry, thread in self.threads.items()
+                         if self.active or not thread.pausable}
+            self.pending = set(refreshed)
+            self.refresh_deadline = monotonic() + self.refresh_timeout
+            if self.recorder:
+                self.recorder.record('refresh', sections=sorted(self.pending))
+            for thread in refreshed.values():
+                thread.refresh()
+            if not self.pending and self.active:
+                self._print_data()
+
+    def _read_config(self):
+        config = ConfigParser()
+        self.config_files = config.read([expanduser('~/.py3status.conf'),
+                                         expanduser('~/py3status.conf'),
+                                         'py3status.conf', 
+                                         '/etc/py3status.conf'
+                                         ])
+        # Options for py3status itself, only used on startup
+        settings = {}
+        for option, default in self.settings.items():
+            settings[option] = config['DEFAULT'].pop(option, default)
+        self.refresh_timeout = float(settings['refresh_timeout'])
+        return config, settings
+
+    def _start_logging(self, settings):
+        '''
+        Workers only put records on a queue, a single background thread
+        writes them to the rotated log file.
+        '''
+        loglevel = getattr(logging, settings['loglevel'].upper())
+        writer = logging.handlers.RotatingFileHandler(
+            settings['logfile'],
+            maxBytes=int(settings['log_max_bytes']),
+            backupCount=int(settings['log_backups']))
+        writer.setFormatter(logging.Formatter('%(asctime)s %(levelname)s : %(message)s'))
+        handler = LogQueueHandler(writer)
+        handler.addFilter(LogThrottle(settings['log_rate'],
+                                      settings['log_repeat_interval']))
+        root = logging.getLogger()
+        root.setLevel(loglevel)
+        root.addHandler(handler)
+        handler.start()
         
     def _start_threads(self):
-        config = ConfigParser()
-        config.read([expanduser('~/.py3status.conf'),
-                     expanduser('~/py3status.conf'),
-                    'py3status.conf', 
-                    '/etc/py3status.conf'
-                    ])
+        config, settings = self._read_config()
         
         #Initialize logging
-        logfile = config['DEFAULT'].pop('logfile')
-        loglevel = getattr(logging, config['DEFAULT'].pop('loglevel').upper())
-        logging.basicConfig(filename=logfile, level=loglevel, format='%(asctime)s %(levelname)s : %(message)s')
+        self._start_logging(settings)
         logging.info('Begin logging.')
         
         #Observer
         self.observer = FIFObserver()
         self.clickeventhandler = ClickEventHandler()
+        self.observer.recorder = self.recorder
+        self.clickeventhandler.recorder = self.recorder
         self.observer.start()
         logging.info('Started Observer')
-        self.clickeventhandler.start()
-        logging.info('Started Click Handler')
         
+        if self.socket_path:
+            # Clicks come from the clients, not from stdin
+            self.server = BarServer(self.socket_path, self.clickeventhandler)
+            self.server.start()
+            logging.info('Started Bar Server')
+        else:
+            self.clickeventhandler.start()
+            logging.info('Started Click Handler')
+
+        self._apply_config(config)
+
+        if settings['metrics_socket']:
+            self.metrics_server = MetricsServer(expanduser(settings['metrics_socket']), self)
+            self.metrics_server.start()
+            logging.info('Started Metrics Server')
+
+        self.profiler = Profiler(self.observer, settings['profile_interval'], self.observer.dir)
+        self.profiler.start()
+        logging.info('Started Profiler')
+
+        self.watcher = ConfigWatcher(self, self.observer, settings['reload_interval'])
+        self.watcher.start()
+        logging.info('Started Config Watcher')
+
+        self.clockwatcher = ClockWatcher(self)
+        self.clockwatcher.start()
+        logging.info('Started Clock Watcher')
+
+    def reload(self):
+        '''
+        Re-read the config and restart only the threads whose
+        sections were added or changed.
+        '''
+        config, settings = self._read_config()
+        logging.info('Reloading config.')
+        self._apply_config(config)
+
+    def _apply_config(self, config):
         order = config['DEFAULT'].pop('order').split()
         separator = config['DEFAULT'].getboolean('separator')
         config['DEFAULT'].pop('separator')
+        for entry in order[:]:
+            if entry not in config:
+                logging.error('No section %s in the config, skipping it.', entry)
+                order.remove(entry)
+        sections = {}
+        for entry in order:
+            sections[entry] = dict(config[entry].items())
+            sections[entry]['separator'] = sections[entry].get('separator', separator)
 
-        # Initialize threads and start them.
-        # While at it, populate data list
-        for i, entry in enumerate(order):
-            arguments = {'idn': i,
-                         'queue': self.updates
-                         }
-            observe = config[entry].getboolean('observer')
-            if observe:
-                config[entry].pop('observer')
-                arguments['observer'] = self.observer
-            class_type = config[entry].pop('class_type')
-            arguments['separator'] = separator
-            # Trick for merging two dictionaries
-            arguments = dict(list(arguments.items()) + list(config[entry].items()))
-            self.threads.append(globals()[class_type](**arguments))
-            self.data.append(None)
-            logging.info('Started thread %s', self.threads[i].name)
-            self.threads[i].start()
-            
+        with self.lock:
+            restarted = []
+            for entry in list(self.threads):
+                if entry not in sections:
+                    self._stop_thread(entry)
+                    restarted.append(entry)
+
+            # Initialize threads and start them. A section that fails to
+            # start keeps its old thread, if it had one.
+            for entry in order:
+                old = self.threads.get(entry)
+                if old is not None and sections[entry] == self.sections.get(entry):
+                    continue
+                commands = []
+                if hasattr(old, 'commandq'):
+                    # The new thread registers the same ones
+                    commands = self.observer.unregister_queue(old.commandq)
+                thread = self._build_thread(entry, config[entry], separator)
+                if thread is None:
+                    for command in commands:
+                        self.observer.register_command(command, old.commandq)
+                    if old is not None:
+                        sections[entry] = self.sections[entry]
+                    else:
+                        del sections[entry]  # tried again on the next reload
+                    continue
+                if old is not None:
+                    self._stop_thread(entry)
+                self._start_thread(entry, thread)
+                if entry not in restarted:
+                    restarted.append(entry)
+            self.sections = sections
+            self.order = order
+            if self.recorder:
+                self.recorder.record('order', order=order, restarted=restarted)
+            if self.active:
+                self._print_data()
+
+    def _build_thread(self, entry, section, separator):
+        '''Returns a thread for the section, or None if it can't be made.'''
+        known = self.observer.registered()
+        try:
+            return self._make_thread(entry, section, separator)
+        except Exception as e:
+            logging.exception('Couldn\'t start %s!', entry)
+            # Nobody would read the queues it registered
+            for command in self.observer.registered() - known:
+                self.observer.unregister_command(command)
+            return None
+
+    def _make_thread(self, entry, section, separator):
+        arguments = {'idn': entry,
+                     'queue': self.updates
+                     }
+        observe = section.getboolean('observer')
+        if observe:
+            section.pop('observer')
+            arguments['observer'] = self.observer
+        in_process = section.getboolean('process', False)
+        if 'process' in section:
+            section.pop('process')
+        class_type = section.pop('class_type')
+        arguments['separator'] = separator
+        # Trick for merging two dictionaries
+        arguments = dict(list(arguments.items()) + list(section.items()))
+        if in_process and observe:
+            # Commands arrive through the observer living in this
+            # process, so these have to stay here.
+            logging.warning('%s takes commands, can\'t run it in a separate process.', entry)
+            in_process = False
+        if in_process:
+            return ProcessWorker(class_type, arguments)
+        return globals()[class_type](**arguments)
+
+    def _start_thread(self, entry, thread):
+        self.threads[entry] = thread
+        self.data[entry] = None
+        logging.info('Started thread %s', thread.name)
+        thread.start()
+
+    def _stop_thread(self, entry):
+        thread = self.threads.pop(entry)
+        self.data.pop(entry, None)
+        if hasattr(thread, 'commandq'):
+            self.observer.unregister_queue(thread.commandq)
+        thread.stop()
+        logging.info('Stopped thread %s', thread.name)
     
     def _handle_updates(self):
         while self.updates:
-            # Blocks here, message expected is (thread id, get_output() with output or None)
-            idn, entry = self.updates.get()
-            self.updates.task_done()
-            self.data[idn] = entry
-            if self.active:
-                self._print_data()
+            timeout = None
+            if self.pending and self.refresh_deadline is not None:
+                timeout = max(self.refresh_deadline - monotonic(), 0)
+            try:
+                # Blocks here, message expected is (section, get_output() with output or None)
+                idn, entry = self.updates.get(timeout=timeout)
+            except Empty:
+                # Gave up waiting for the rest of a refresh
+                with self.lock:
+                    if self.recorder:
+                        self.recorder.record('timeout')
+                    self.pending.clear()
+                    if self.active:
+                        self._print_data()
+                continue
+            try:
+                if idn is None:
+                    break
+                with self.lock:
+                    if self.recorder:
+                        self.recorder.record('update', section=idn, output=entry)
+                    # Late messages from stopped threads are dropped
+                    if idn in self.sections:
+                        self.data[idn] = entry
+                    self.pending.discard(idn)
+                    if self.active and not self.pending:
+                        self._print_data()
+            finally:
+                # Only now, the Replayer waits for updates to be handled
+                self.updates.task_done()
             
     def _print_data(self):
-        items = [item for item in self.data if item]
+        if self.server:
+            self.server.broadcast(self.data, self.order)
+            if not self.recorder:
+                return
+        items = [self.data[entry] for entry in self.order if self.data.get(entry)]
         if items:
-            print(self.comma, json.dumps(items), flush=True, sep='')
-            self.comma = ','
+            frame = self.encoder.encode(items)
+            if self.recorder:
+                self.recorder.record('frame', frame=frame.decode())
+            if self.output:
+                self.output.put(frame)
         
     def run(self):
-        print('{"version":1, "click_events": true, "stop_signal": 10, "cont_signal": 12 }\n[', flush=True)
+        if not self.socket_path:
+            self.output = Output(self.encoder)
+            self.output.start()
         try:
             self._start_threads()
             self._handle_updates()
@@ -916,10 +2821,57 @@ class StatusBar():
             logging.exception('Caught exception in the main thread!')
             sys.exit(1)
 
+    def replay(self, path, fast=False):
+        '''
+        Run the output side of the StatusBar on a recording, without
+        starting any threads. Exits with 1 if the frames differ.
+        '''
+        self.output = Output(self.encoder)
+        self.output.start()
+        replayer = Replayer(path, self, fast)
+        self.recorder = replayer
+        start = monotonic()
+        replayer.start()
+        self._handle_updates()
+        self.output.flush()
+        if replayer.report(monotonic() - start):
+            sys.exit(1)
+
                 
 if __name__ == '__main__':
-    statusbar = StatusBar()
+    parser = argparse.ArgumentParser(description='Statusline generator for i3bar')
+    parser.add_argument('--daemon', action='store_true',
+                        help='collect data once and serve it to bar clients')
+    parser.add_argument('--client', action='store_true',
+                        help='show the output of a running daemon')
+    parser.add_argument('--socket', default='/tmp/{}/py3status.sock'.format(os.getenv('USER')),
+                        help='socket shared by the daemon and its clients')
+    parser.add_argument('--order', nargs='+', default=[],
+                        help='sections shown by this client, default is all')
+    parser.add_argument('--output', choices=sorted(ENCODERS),
+                        help='format to write, default is i3bar, clients pick their own')
+    parser.add_argument('--record', metavar='FILE',
+                        help='write a trace of all input and output to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='feed a recorded trace through the output, without any threads')
+    parser.add_argument('--fast', action='store_true',
+                        help='replay as fast as possible instead of in real time')
+    args = parser.parse_args()
+    if args.daemon and args.output:
+        parser.error('--output is for the clients, the daemon always sends JSON lines')
+
+    recorder = Recorder(args.record) if args.record else None
+    encoder = ENCODERS[args.output or 'i3bar']()
+    if args.client:
+        statusbar = BarClient(args.socket, args.order, encoder)
+    elif args.daemon:
+        statusbar = StatusBar(args.socket, recorder)
+    else:
+        statusbar = StatusBar(recorder=recorder, encoder=encoder)
     handler = lambda sig, frame: statusbar._sig_handler(sig)
     signal.signal(signal.SIGUSR1, handler)
     signal.signal(signal.SIGUSR2, handler)
-    statusbar.run()
+    if args.replay:
+        statusbar.replay(args.replay, args.fast)
+    else:
+        statusbar.run()